@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""harbor_log.py - shared logging for the turtle-harbor scripts.
+
+every line goes to stdout for `th logs`. with LOKI_URL set, it is instead
+queued as a JSON record and pushed to Loki's push API in gzip batches from a
+background thread, labelled with the script, phase and state. it is not also
+printed, because turtle-harbor forwards stdout to Loki and would ingest it a
+second time. the queue is bounded: when Loki is slow or down, the oldest
+records are dropped first.
+
+env vars:
+  LOKI_URL            - Loki base URL, e.g. http://192.168.198.3:3100 (default: off)
+  LOKI_LABELS         - static labels, e.g. host=raspberry-pi,env=home
+  LOKI_BATCH          - records per push (default: 1000)
+  LOKI_BUFFER         - records held while Loki is unreachable (default: 10000)
+  LOKI_FLUSH_INTERVAL - seconds between pushes of a partial batch (default: 2)
+
+usage:
+  python harbor_log.py --test    # run embedded tests
+"""
+
+import atexit
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+
+LOKI_URL = os.environ.get("LOKI_URL", "")
+LOKI_LABELS = os.environ.get("LOKI_LABELS", "")
+LOKI_BATCH = int(os.environ.get("LOKI_BATCH", "1000"))
+LOKI_BUFFER = int(os.environ.get("LOKI_BUFFER", "10000"))
+LOKI_FLUSH_INTERVAL = float(os.environ.get("LOKI_FLUSH_INTERVAL", "2"))
+LOKI_PUSH_PATH = "/loki/api/v1/push"
+LOKI_TIMEOUT = 5
+LOKI_RETRY_MAX = 60
+LOKI_CLOSE_TIMEOUT = 5
+
+# bound fields that become Loki stream labels; everything else stays in the JSON line
+LABEL_KEYS = ("phase", "state")
+
+_fields: contextvars.ContextVar[dict] = contextvars.ContextVar("harbor_log_fields", default={})
+
+
+def bind(**fields) -> None:
+    # adds fields to every record logged from the current context: an asyncio
+    # task, or a thread started with a copy of the context. None removes a field
+    merged = {**_fields.get(), **fields}
+    _fields.set({k: v for k, v in merged.items() if v is not None})
+
+
+def bound() -> dict:
+    return dict(_fields.get())
+
+
+def parse_labels(spec: str) -> dict[str, str]:
+    labels = {}
+    for item in spec.split(","):
+        name, sep, value = item.partition("=")
+        if not item.strip():
+            continue
+        if not sep or not name.strip():
+            raise ValueError(f"label {item.strip()!r} is not name=value")
+        labels[name.strip()] = value.strip()
+    return labels
+
+
+class LokiShipper:
+    # records wait in a bounded deque; a daemon thread pushes them whenever a
+    # batch fills or flush_interval passes. A failed push is retried with
+    # exponential backoff and, if new records filled the queue meanwhile, loses
+    # its oldest records rather than the newest
+    def __init__(self, url: str, labels: dict[str, str] | None = None, batch: int = LOKI_BATCH,
+                 capacity: int = LOKI_BUFFER, flush_interval: float = LOKI_FLUSH_INTERVAL,
+                 timeout: float = LOKI_TIMEOUT) -> None:
+        self.url = url.rstrip("/") + LOKI_PUSH_PATH
+        self.labels = labels or {}
+        self.batch = batch
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.queue: deque[tuple[tuple, str, str]] = deque()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stopping = threading.Event()
+        self.thread: threading.Thread | None = None
+        # the HTTP stack is only loaded when logs are actually shipped
+        import urllib.request
+        self.opener = urllib.request.build_opener()
+        self.pushed = 0
+        self.dropped = 0
+        self.failures = 0
+
+    def emit(self, labels: dict[str, str], ts_ns: int, line: str) -> None:
+        key = tuple(sorted({**self.labels, **labels}.items()))
+        with self.lock:
+            if len(self.queue) >= self.capacity:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append((key, str(ts_ns), line))
+            full = len(self.queue) >= self.batch
+        if full:
+            self.ready.set()
+
+    def start(self) -> "LokiShipper":
+        self.thread = threading.Thread(target=self.run, name="loki-shipper", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+        return self
+
+    def run(self) -> None:
+        delay = 1.0
+        while not self.stopping.is_set():
+            self.ready.wait(self.flush_interval)
+            self.ready.clear()
+            while not self.stopping.is_set():
+                sent = self.flush()
+                if sent is None:
+                    # Loki is unreachable: back off, the queue keeps the newest records
+                    self.stopping.wait(delay)
+                    delay = min(delay * 2, LOKI_RETRY_MAX)
+                    continue
+                delay = 1.0
+                if sent < self.batch:
+                    break
+
+    def take(self) -> list[tuple[tuple, str, str]]:
+        with self.lock:
+            n = min(self.batch, len(self.queue))
+            return [self.queue.popleft() for _ in range(n)]
+
+    def requeue(self, records: list[tuple[tuple, str, str]]) -> None:
+        with self.lock:
+            room = self.capacity - len(self.queue)
+            keep = records[len(records) - room:] if room < len(records) else records
+            self.dropped += len(records) - len(keep)
+            self.queue.extendleft(reversed(keep))
+
+    def flush(self) -> int | None:
+        # pushes one batch; returns its size, or None when the push failed
+        import urllib.error
+
+        records = self.take()
+        if not records:
+            return 0
+        try:
+            self.push(records)
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            self.failures += 1
+            if self.failures == 1:
+                # not through log(): this record would only join the queue that is stuck
+                print(f"loki push to {self.url} failed: {e}", file=sys.stderr, flush=True)
+            self.requeue(records)
+            return None
+        if self.failures:
+            print(f"loki push recovered after {self.failures} failures, {self.dropped} records dropped so far",
+                  file=sys.stderr, flush=True)
+            self.failures = 0
+        self.pushed += len(records)
+        return len(records)
+
+    def push(self, records: list[tuple[tuple, str, str]]) -> None:
+        import gzip
+        import urllib.request
+
+        streams: dict[tuple, list[list[str]]] = {}
+        for key, ts, line in records:
+            streams.setdefault(key, []).append([ts, line])
+        payload = {"streams": [{"stream": dict(key), "values": values} for key, values in streams.items()]}
+        body = gzip.compress(json.dumps(payload, separators=(",", ":")).encode(), compresslevel=6)
+        req = urllib.request.Request(self.url, data=body, method="POST", headers={
+            "Content-Type": "application/json",
+            "Content-Encoding": "gzip",
+        })
+        with self.opener.open(req, timeout=self.timeout) as resp:
+            resp.read()
+
+    def close(self, timeout: float = LOKI_CLOSE_TIMEOUT) -> None:
+        # one last pass over whatever is queued, bounded so exit never hangs on Loki
+        if self.thread is None or self.stopping.is_set():
+            return
+        self.stopping.set()
+        self.ready.set()
+        self.thread.join(timeout)
+        deadline = time.monotonic() + timeout
+        while self.queue and time.monotonic() < deadline:
+            if not self.flush():
+                break
+
+
+class Logger:
+    def __init__(self, script: str, shipper: LokiShipper | None = None) -> None:
+        self.script = script
+        self.shipper = shipper
+
+    def __call__(self, msg: str, level: str = "info", **fields) -> None:
+        now = time.time_ns()
+        if self.shipper is None:
+            ts = datetime.fromtimestamp(now / 1e9, timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+            print(f"[{ts}] {msg}", flush=True)
+            return
+        fields = {**_fields.get(), **fields}
+        labels = {"script": self.script}
+        for key in LABEL_KEYS:
+            if key in fields:
+                labels[key] = str(fields.pop(key))
+        line = json.dumps({"level": level, "msg": msg, **fields}, default=str, ensure_ascii=False)
+        self.shipper.emit(labels, now, line)
+
+
+def start_shipper() -> LokiShipper | None:
+    if not LOKI_URL:
+        return None
+    return LokiShipper(LOKI_URL, parse_labels(LOKI_LABELS)).start()
+
+
+class LokiStub:
+    # local stand-in for Loki's push API: keeps the decoded pushes, answers
+    # fail_pushes 503s first, and holds every request for delay seconds
+    def __init__(self) -> None:
+        import gzip
+        import http.server
+
+        self.pushes: list[dict] = []
+        self.encodings: list[str | None] = []
+        self.fail_pushes = 0
+        self.delay = 0.0
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+                time.sleep(stub.delay)
+                if self.path != LOKI_PUSH_PATH:
+                    self._reply(404)
+                    return
+                if stub.fail_pushes > 0:
+                    stub.fail_pushes -= 1
+                    self._reply(503)
+                    return
+                encoding = self.headers.get("Content-Encoding")
+                stub.encodings.append(encoding)
+                stub.pushes.append(json.loads(gzip.decompress(body) if encoding == "gzip" else body))
+                self._reply(204)
+
+            def _reply(self, status: int) -> None:
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def entries(self) -> list[tuple[dict, dict]]:
+        # (labels, decoded JSON line) for every pushed record, in push order
+        return [(stream["stream"], json.loads(line))
+                for push in self.pushes for stream in push["streams"] for _, line in stream["values"]]
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def run_tests() -> None:
+    import io
+    import unittest
+    from contextlib import redirect_stdout
+    from unittest.mock import patch
+
+    def wait_for(predicate, timeout: float = 5.0) -> bool:
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    class TestLabels(unittest.TestCase):
+        def test_parses_static_labels(self):
+            self.assertEqual(parse_labels("host=raspberry-pi, env = home"), {"host": "raspberry-pi", "env": "home"})
+            self.assertEqual(parse_labels(""), {})
+            with self.assertRaises(ValueError):
+                parse_labels("host")
+
+        def test_bound_fields_follow_the_context(self):
+            def worker(seen: list) -> None:
+                bind(phase="record")
+                seen.append(bound())
+
+            def scenario() -> tuple[dict, list]:
+                bind(phase="monitor", state="LIVE")
+                seen = []
+                context = contextvars.copy_context()
+                thread = threading.Thread(target=context.run, args=(worker, seen))
+                thread.start()
+                thread.join()
+                return bound(), seen
+
+            outer, seen = contextvars.copy_context().run(scenario)
+            self.assertEqual(outer, {"phase": "monitor", "state": "LIVE"})
+            self.assertEqual(seen, [{"phase": "record", "state": "LIVE"}])
+            self.assertEqual(bound(), {})
+
+    class TestLogger(unittest.TestCase):
+        def test_queues_json_record_instead_of_printing(self):
+            shipper = LokiShipper("http://loki.invalid", {"host": "pi"})
+            log = Logger("radio-t-monitor", shipper)
+            out = io.StringIO()
+
+            def scenario() -> None:
+                bind(phase="record", state="LIVE", stream="radio-t")
+                log("recording: 100 bytes", bytes=100)
+
+            with redirect_stdout(out):
+                contextvars.copy_context().run(scenario)
+
+            self.assertEqual(out.getvalue(), "")
+            key, ts, line = shipper.queue[0]
+            self.assertEqual(dict(key), {"host": "pi", "script": "radio-t-monitor", "phase": "record", "state": "LIVE"})
+            self.assertAlmostEqual(int(ts) / 1e9, time.time(), delta=5)
+            self.assertEqual(json.loads(line), {"level": "info", "msg": "recording: 100 bytes", "stream": "radio-t", "bytes": 100})
+
+        def test_without_shipper_only_prints(self):
+            out = io.StringIO()
+            with redirect_stdout(out):
+                Logger("twitch-nfo-generator")("done")
+            self.assertRegex(out.getvalue(), r"^\[\d{4}-\d\d-\d\d \d\d:\d\d:\d\d UTC\] done\n$")
+
+    class TestLokiShipper(unittest.TestCase):
+        def setUp(self):
+            self.stub = LokiStub()
+            self.addCleanup(self.stub.close)
+
+        def test_pushes_gzip_batches_grouped_by_labels(self):
+            shipper = LokiShipper(self.stub.url, {"host": "pi"}, batch=3, flush_interval=0.05)
+            for i in range(5):
+                shipper.emit({"script": "s", "phase": "scan" if i % 2 else "write"}, 1000 + i, f'{{"msg": "{i}"}}')
+            self.assertEqual(shipper.flush(), 3)
+            self.assertEqual(shipper.flush(), 2)
+            self.assertEqual(shipper.flush(), 0)
+
+            self.assertEqual(self.stub.encodings, ["gzip", "gzip"])
+            first = self.stub.pushes[0]["streams"]
+            self.assertEqual([(s["stream"]["phase"], [v[0] for v in s["values"]]) for s in first],
+                             [("write", ["1000", "1002"]), ("scan", ["1001"])])
+            self.assertEqual(first[0]["stream"], {"host": "pi", "phase": "write", "script": "s"})
+            self.assertEqual(shipper.pushed, 5)
+
+        def test_background_thread_flushes_partial_batch(self):
+            shipper = LokiShipper(self.stub.url, batch=100, flush_interval=0.05).start()
+            self.addCleanup(shipper.close)
+            with redirect_stdout(io.StringIO()):
+                Logger("s", shipper)("hello")
+            self.assertTrue(wait_for(lambda: self.stub.pushes))
+            self.assertEqual(self.stub.entries()[0][1]["msg"], "hello")
+
+        def test_full_batch_is_pushed_without_waiting(self):
+            shipper = LokiShipper(self.stub.url, batch=10, flush_interval=60).start()
+            self.addCleanup(shipper.close)
+            for i in range(10):
+                shipper.emit({"script": "s"}, i, "{}")
+            self.assertTrue(wait_for(lambda: shipper.pushed == 10))
+
+        def test_buffer_drops_oldest(self):
+            shipper = LokiShipper(self.stub.url, batch=100, capacity=3)
+            for i in range(5):
+                shipper.emit({"script": "s"}, i, str(i))
+            self.assertEqual(shipper.dropped, 2)
+            self.assertEqual([line for _, _, line in shipper.queue], ["2", "3", "4"])
+
+        def test_failed_push_is_retried_and_loses_oldest_first(self):
+            self.stub.fail_pushes = 1
+            shipper = LokiShipper(self.stub.url, batch=3, capacity=4)
+            for i in range(3):
+                shipper.emit({"script": "s"}, i, str(i))
+            with redirect_stdout(io.StringIO()), patch("sys.stderr", io.StringIO()) as err:
+                self.assertIsNone(shipper.flush())
+                # two newer records arrive while Loki is down: the oldest failed one goes
+                shipper.emit({"script": "s"}, 3, "3")
+                shipper.emit({"script": "s"}, 4, "4")
+                self.assertEqual(shipper.flush(), 3)
+                self.assertEqual(shipper.flush(), 1)
+            self.assertIn("loki push", err.getvalue())
+            self.assertEqual(shipper.dropped, 1)
+            self.assertEqual([line for _, line in self.stub.entries()], [1, 2, 3, 4])
+
+        def test_slow_loki_never_blocks_logging(self):
+            self.stub.delay = 1.0
+            shipper = LokiShipper(self.stub.url, batch=10, capacity=50, flush_interval=0.01).start()
+            self.addCleanup(shipper.close, 0.1)
+            log = Logger("s", shipper)
+            started = time.monotonic()
+            with redirect_stdout(io.StringIO()):
+                for i in range(1000):
+                    log(f"line {i}")
+            self.assertLess(time.monotonic() - started, 0.5)
+            self.assertLessEqual(len(shipper.queue), 50)
+            self.assertGreaterEqual(shipper.dropped, 1000 - 50 - 10)
+
+        def test_close_flushes_queue(self):
+            shipper = LokiShipper(self.stub.url, batch=2, flush_interval=60).start()
+            shipper.emit({"script": "s"}, 1, "{}")
+            shipper.close()
+            self.assertEqual(shipper.pushed, 1)
+
+        def test_unreachable_loki_reports_once(self):
+            shipper = LokiShipper("http://127.0.0.1:9", timeout=0.5)
+            shipper.emit({"script": "s"}, 1, "{}")
+            with patch("sys.stderr", io.StringIO()) as err:
+                self.assertIsNone(shipper.flush())
+                self.assertIsNone(shipper.flush())
+            self.assertEqual(err.getvalue().count("loki push"), 1)
+            self.assertEqual(len(shipper.queue), 1)
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for tc in [TestLabels, TestLogger, TestLokiShipper]:
+        suite.addTests(loader.loadTestsFromTestCase(tc))
+    runner = unittest.TextTestRunner(verbosity=2)
+    result = runner.run(suite)
+    sys.exit(0 if result.wasSuccessful() else 1)
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Shared log shipping for the turtle-harbor scripts")
+    parser.add_argument("--test", action="store_true", help="run embedded unit tests")
+    args = parser.parse_args()
+
+    if args.test:
+        run_tests()
+        return
+    parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
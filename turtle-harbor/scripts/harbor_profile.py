@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+"""harbor_profile.py - profiling switch shared by the turtle-harbor scripts.
+
+--profile cpu|mem|all profiles a whole run, or its first --profile-seconds.
+SIGUSR2 profiles a running process for PROFILE_SIGNAL_SECONDS without a
+restart; a second SIGUSR2 during that window writes a snapshot straight away.
+
+output, one set per run or snapshot, in PROFILE_DIR:
+  <script>-<time>.pstats       cProfile, for `python -m pstats` or snakeviz
+  <script>-<time>.collapsed    sampled stacks of every thread, for flamegraph.pl or speedscope
+  <script>-<time>.tracemalloc  tracemalloc snapshot, for tracemalloc.Snapshot.load()
+  <script>-<time>-memory.txt   largest allocation sites and peak traced memory
+
+env vars:
+  PROFILE_DIR            - where profiles are written (default: ./profiles next to the scripts)
+  PROFILE_SIGNAL_MODES   - what SIGUSR2 profiles: cpu, mem or all (default: all)
+  PROFILE_SIGNAL_SECONDS - length of a SIGUSR2 window (default: 60)
+  PROFILE_MEMORY_FRAMES  - traceback depth kept per allocation (default: 10, 1 is several times cheaper)
+  STARTUP_BUDGET_SCALE   - multiplies the start-up budgets the scripts' tests enforce (default: 1, raise on slow hosts)
+
+usage:
+  python harbor_profile.py --startup    # time each script's no-op run in fresh interpreters
+  python harbor_profile.py --test       # run embedded tests
+"""
+
+import atexit
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+# type checkers treat this as true; importing typing for it would cost every script's start-up
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    # cProfile is imported when a session starts, see Profiler.start
+    import cProfile
+
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+PROFILE_SIGNAL_MODES = os.environ.get("PROFILE_SIGNAL_MODES", "all")
+PROFILE_SIGNAL_SECONDS = float(os.environ.get("PROFILE_SIGNAL_SECONDS", "60"))
+PROFILE_MEMORY_FRAMES = int(os.environ.get("PROFILE_MEMORY_FRAMES", "10"))
+STARTUP_BUDGET_SCALE = float(os.environ.get("STARTUP_BUDGET_SCALE", "1"))
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_INTERVAL = 0.01
+MEMORY_TOP = 30
+MODES = ("cpu", "mem", "all")
+
+
+def parse_modes(mode: str) -> set[str]:
+    if mode not in MODES:
+        raise ValueError(f"profile mode {mode!r} is not one of {', '.join(MODES)}")
+    return {"cpu", "mem"} if mode == "all" else {mode}
+
+
+class StackSampler:
+    # cProfile's pstats only keeps caller/callee pairs; flame graphs need whole
+    # stacks, so this samples every thread's stack on a timer and counts them
+    # in collapsed form: "thread;outer (file:line);inner (file:line) count"
+    def __init__(self, interval: float = SAMPLE_INTERVAL) -> None:
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, name="stack-sampler", daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = [self.collapse(names.get(ident, f"thread-{ident}"), frame)
+                      for ident, frame in sys._current_frames().items() if ident != own]
+            with self.lock:
+                self.stacks.update(stacks)
+
+    @staticmethod
+    def collapse(thread: str, frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        names.append(thread)
+        return ";".join(reversed(names))
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def write(self, path: str) -> None:
+        with self.lock:
+            stacks = self.stacks.most_common()
+        with open(path, "w") as f:
+            for stack, count in stacks:
+                f.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    # one profiling session: cProfile and the stack sampler for "cpu",
+    # tracemalloc for "mem". snapshot() writes what was gathered so far and
+    # keeps going, stop() writes and ends the session
+    def __init__(self, script: str, modes: set[str], directory: str = PROFILE_DIR,
+                 log=print) -> None:
+        self.script = script
+        self.modes = modes
+        self.directory = directory
+        self.log = log
+        self.lock = threading.Lock()
+        self.profile: "cProfile.Profile | None" = None
+        self.sampler: StackSampler | None = None
+        self.traced = False
+        self.active = False
+        self.started = 0.0
+        self.timer: threading.Timer | None = None
+
+    def start(self, seconds: float = 0) -> "Profiler":
+        # imported here: a run without --profile or a signal never loads them
+        import cProfile
+        import tracemalloc
+
+        with self.lock:
+            if "mem" in self.modes and not tracemalloc.is_tracing():
+                tracemalloc.start(PROFILE_MEMORY_FRAMES)
+                self.traced = True
+            if "cpu" in self.modes:
+                self.sampler = StackSampler()
+                self.sampler.start()
+                self.profile = cProfile.Profile()
+                self.profile.enable()
+            self.active = True
+            self.started = time.monotonic()
+        if seconds > 0:
+            self.timer = threading.Timer(seconds, self.stop)
+            self.timer.daemon = True
+            self.timer.start()
+        self.log(f"profiling {'+'.join(sorted(self.modes))} "
+                 f"{f'for {seconds:.0f}s' if seconds > 0 else 'until exit'}, writing to {self.directory}")
+        return self
+
+    def snapshot(self, blocking: bool = True) -> list[str]:
+        if not self.lock.acquire(blocking):
+            return []
+        try:
+            if not self.active:
+                return []
+            return self.write(finished=False)
+        finally:
+            self.lock.release()
+
+    def stop(self) -> list[str]:
+        with self.lock:
+            if not self.active:
+                return []
+            if self.timer is not None:
+                self.timer.cancel()
+            try:
+                return self.write(finished=True)
+            finally:
+                self.active = False
+
+    def write(self, finished: bool) -> list[str]:
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+        prefix = os.path.join(self.directory, f"{self.script}-{stamp}")
+        n = 1
+        while os.path.exists(f"{prefix}.pstats") or os.path.exists(f"{prefix}-memory.txt"):
+            n += 1
+            prefix = os.path.join(self.directory, f"{self.script}-{stamp}-{n}")
+        paths = []
+        if self.profile is not None:
+            # dump_stats disables the profiler, so a snapshot re-enables it
+            self.profile.dump_stats(f"{prefix}.pstats")
+            if not finished:
+                self.profile.enable()
+            paths.append(f"{prefix}.pstats")
+        if self.sampler is not None:
+            if finished:
+                self.sampler.stop()
+            self.sampler.write(f"{prefix}.collapsed")
+            paths.append(f"{prefix}.collapsed")
+        if "mem" in self.modes:
+            import tracemalloc
+
+            if tracemalloc.is_tracing():
+                paths += self.write_memory(prefix)
+                if finished and self.traced:
+                    tracemalloc.stop()
+        self.log(f"profile {'written' if finished else 'snapshot'} after {time.monotonic() - self.started:.1f}s: "
+                 f"{', '.join(os.path.basename(p) for p in paths)}")
+        return paths
+
+    def write_memory(self, prefix: str) -> list[str]:
+        import cProfile
+        import tracemalloc
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            # the profiler's own bookkeeping and module loading
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+        snapshot.dump(f"{prefix}.tracemalloc")
+        current, peak = tracemalloc.get_traced_memory()
+        stats = snapshot.statistics("lineno")
+        with open(f"{prefix}-memory.txt", "w") as f:
+            f.write(f"traced memory: current {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB\n")
+            f.write(f"top {MEMORY_TOP} allocation sites of {len(stats)}:\n")
+            for stat in stats[:MEMORY_TOP]:
+                frame = stat.traceback[0]
+                f.write(f"{stat.size / 1024:10.1f} KiB {stat.count:8} blocks  {frame.filename}:{frame.lineno}\n")
+        return [f"{prefix}.tracemalloc", f"{prefix}-memory.txt"]
+
+
+class SignalTrigger:
+    # SIGUSR2 starts a PROFILE_SIGNAL_SECONDS window, or snapshots the session
+    # already running. The handler never waits on the profiler lock: it runs
+    # on the main thread, which may be the one holding it
+    def __init__(self, script: str, log=print, modes: str = PROFILE_SIGNAL_MODES,
+                 seconds: float = PROFILE_SIGNAL_SECONDS, directory: str = PROFILE_DIR) -> None:
+        self.script = script
+        self.log = log
+        self.modes = parse_modes(modes)
+        self.seconds = seconds
+        self.directory = directory
+        self.profiler: Profiler | None = None
+
+    def install(self, signum: int = signal.SIGUSR2) -> "SignalTrigger":
+        signal.signal(signum, self.handle)
+        return self
+
+    def handle(self, signum, frame) -> None:
+        if self.profiler is not None and self.profiler.active:
+            if not self.profiler.snapshot(blocking=False):
+                self.log("profiler busy, snapshot skipped")
+            return
+        self.profiler = Profiler(self.script, self.modes, self.directory, self.log).start(self.seconds)
+
+
+def add_arguments(parser) -> None:
+    parser.add_argument("--profile", choices=MODES, help="profile this run: cProfile + sampled stacks, tracemalloc, or both")
+    parser.add_argument("--profile-seconds", type=float, default=0, metavar="N",
+                        help="stop profiling after N seconds instead of at exit")
+    parser.add_argument("--profile-dir", default=PROFILE_DIR, metavar="DIR", help=f"output directory (default: {PROFILE_DIR})")
+
+
+def exit_on_sigterm(signum, frame) -> None:
+    sys.exit(128 + signum)
+
+
+def setup(script: str, args, log=print) -> SignalTrigger:
+    # SIGUSR2 is always armed; --profile additionally profiles from here on
+    trigger = SignalTrigger(script, log, directory=args.profile_dir).install()
+    if args.profile:
+        trigger.profiler = Profiler(script, parse_modes(args.profile), args.profile_dir, log).start(args.profile_seconds)
+        atexit.register(trigger.profiler.stop)
+        # `th down` sends SIGTERM: exit through atexit so a whole-run profile is still written
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, exit_on_sigterm)
+    return trigger
+
+
+class StartupReport:
+    # what one command costs to start: wall time of every fresh run, the
+    # largest peak RSS among them and -X importtime's self time per module
+    def __init__(self, argv: list[str], exit_code: int, wall_ms: list[float], rss_kib: int,
+                 imports: dict[str, int]) -> None:
+        self.argv = argv
+        self.exit_code = exit_code
+        self.wall_ms = sorted(wall_ms)
+        self.rss_kib = rss_kib
+        self.imports = imports
+
+    @property
+    def median_ms(self) -> float:
+        return self.wall_ms[len(self.wall_ms) // 2]
+
+    @property
+    def import_ms(self) -> float:
+        return sum(self.imports.values()) / 1000
+
+    def loaded(self, *packages: str) -> list[str]:
+        return sorted(m for m in self.imports if m.split(".")[0] in packages or m in packages)
+
+
+def parse_importtime(stderr: str) -> dict[str, int]:
+    # "import time: <self us> | <cumulative us> | <indented module>"
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        own, _, name = line.removeprefix("import time:").split("|")
+        if own.strip().isdigit():
+            imports[name.strip()] = int(own)
+    return imports
+
+
+def measure_startup(argv: list[str], env: dict[str, str] | None = None, runs: int = 5) -> StartupReport:
+    # every run is a fresh interpreter timed from spawn to exit; wait4 gives
+    # that child's own peak RSS. One extra run under -X importtime lists what
+    # it loaded. The page cache stays warm, so this is the interpreter's cold
+    # start, not the disk's. The bytecode cache is on, as under cron, and an
+    # untimed first run fills it
+    import subprocess
+
+    env = {**os.environ, **(env or {})}
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    subprocess.run([sys.executable, *argv], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wall_ms, rss_kib, exit_code = [], 0, 0
+    for _ in range(runs):
+        started = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, *argv], env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall_ms.append((time.perf_counter() - started) * 1000)
+        proc.returncode = exit_code = os.waitstatus_to_exitcode(status)
+        rss_kib = max(rss_kib, usage.ru_maxrss)
+    traced = subprocess.run([sys.executable, "-X", "importtime", *argv], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    return StartupReport(argv, exit_code, wall_ms, rss_kib, parse_importtime(traced.stderr))
+
+
+def bench_startup(runs: int = 10) -> None:
+    # the runs that happen most: an hourly generator pass with nothing new and
+    # the monitor's --check; bare python is the floor both sit on
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as twitch_dir:
+        with open(os.path.join(twitch_dir, "v1-info.json"), "w") as f:
+            f.write("{}")
+        open(os.path.join(twitch_dir, "v1-video.nfo"), "w").close()
+        cases = [
+            ("python -c pass", ["-c", "pass"], {}),
+            ("twitch-nfo-generator, nothing new", [os.path.join(SCRIPTS_DIR, "twitch-nfo-generator.py")],
+             {"TWITCH_DIR": twitch_dir, "LOKI_URL": ""}),
+            ("radio-t-monitor --check", [os.path.join(SCRIPTS_DIR, "radio-t-monitor.py"), "--check"],
+             {"RELAY_SECRET": "bench", "STREAMS_CONFIG": "", "LOKI_URL": ""}),
+        ]
+        print(f"{'command':36} {'median':>9} {'min':>9} {'peak RSS':>10} {'imports':>9} {'modules':>8}")
+        for name, argv, env in cases:
+            report = measure_startup(argv, env, runs)
+            if report.exit_code != 0:
+                print(f"{name}: exited with {report.exit_code}")
+                continue
+            print(f"{name:36} {report.median_ms:7.1f}ms {report.wall_ms[0]:7.1f}ms "
+                  f"{report.rss_kib / 1024:7.1f}MiB {report.import_ms:7.1f}ms {len(report.imports):8}")
+            slowest = sorted(report.imports.items(), key=lambda item: -item[1])[:5]
+            print(f"{'':36} slowest: {', '.join(f'{m} {us / 1000:.1f}ms' for m, us in slowest)}")
+
+
+def run_tests() -> None:
+    import argparse
+    import pstats
+    import tempfile
+    import tracemalloc
+    import unittest
+
+    def busy_loop(n: int) -> int:
+        total = 0
+        for i in range(n):
+            total += i * i
+        return total
+
+    def allocate_blocks() -> list[bytes]:
+        return [bytes(1024) for _ in range(2000)]
+
+    def wait_for(predicate, timeout: float = 5.0) -> bool:
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    class ProfileTestCase(unittest.TestCase):
+        def setUp(self):
+            tmp = tempfile.TemporaryDirectory()
+            self.addCleanup(tmp.cleanup)
+            self.dir = tmp.name
+            self.lines: list[str] = []
+
+        def files(self, suffix: str) -> list[str]:
+            return sorted(os.path.join(self.dir, name) for name in os.listdir(self.dir) if name.endswith(suffix))
+
+    class TestProfiler(ProfileTestCase):
+        def test_cpu_profile_of_whole_run(self):
+            profiler = Profiler("test", {"cpu"}, self.dir, self.lines.append).start()
+            worker = threading.Thread(target=busy_loop, args=(300000,), name="recorder")
+            worker.start()
+            busy_loop(300000)
+            worker.join()
+            time.sleep(0.05)
+            paths = profiler.stop()
+
+            self.assertEqual([os.path.splitext(p)[1] for p in paths], [".pstats", ".collapsed"])
+            stats = pstats.Stats(paths[0])
+            self.assertIn("busy_loop", {func for _, _, func in stats.stats})
+            with open(paths[1]) as f:
+                stacks = [line.rsplit(" ", 1) for line in f.read().splitlines()]
+            self.assertTrue(all(count.isdigit() for _, count in stacks))
+            self.assertTrue(any(stack.startswith("MainThread;") and "busy_loop" in stack for stack, _ in stacks))
+            self.assertTrue(any(stack.startswith("recorder;") for stack, _ in stacks))
+            self.assertRegex(self.lines[-1], r"^profile written after \d+\.\ds: test-\d{8}-\d{6}\.pstats")
+            self.assertEqual(profiler.stop(), [])
+
+        def test_memory_profile(self):
+            profiler = Profiler("test", {"mem"}, self.dir, self.lines.append).start()
+            blocks = allocate_blocks()
+            paths = profiler.stop()
+            self.assertFalse(tracemalloc.is_tracing())
+            self.assertEqual([os.path.basename(p).split(".")[-1] for p in paths], ["tracemalloc", "txt"])
+            snapshot = tracemalloc.Snapshot.load(paths[0])
+            top = snapshot.statistics("lineno")[0]
+            self.assertGreaterEqual(top.size, 2000 * 1024)
+            with open(paths[1]) as f:
+                report = f.read()
+            self.assertIn("peak", report)
+            self.assertIn(f"{__file__}:{allocate_blocks.__code__.co_firstlineno + 1}", report)
+            del blocks
+
+        def test_fixed_window_stops_by_itself(self):
+            profiler = Profiler("test", {"cpu", "mem"}, self.dir, self.lines.append).start(seconds=0.2)
+            self.assertTrue(wait_for(lambda: not profiler.active))
+            self.assertEqual(len(self.files(".pstats")), 1)
+            self.assertEqual(len(self.files(".tracemalloc")), 1)
+            self.assertIn("for 0s", self.lines[0])
+
+        def test_snapshot_keeps_profiling(self):
+            profiler = Profiler("test", {"cpu"}, self.dir, self.lines.append).start()
+            busy_loop(10000)
+            self.assertEqual(len(profiler.snapshot()), 2)
+            self.assertTrue(profiler.active)
+            busy_loop(10000)
+            profiler.stop()
+            self.assertEqual(len(self.files(".pstats")), 2)
+            self.assertIn("profile snapshot", self.lines[1])
+
+    class TestSignalTrigger(ProfileTestCase):
+        def test_signal_starts_window_then_snapshots(self):
+            trigger = SignalTrigger("test", self.lines.append, modes="cpu", seconds=30, directory=self.dir)
+            previous = signal.getsignal(signal.SIGUSR2)
+            trigger.install()
+            self.addCleanup(signal.signal, signal.SIGUSR2, previous)
+
+            os.kill(os.getpid(), signal.SIGUSR2)
+            self.assertTrue(wait_for(lambda: trigger.profiler is not None))
+            self.assertTrue(trigger.profiler.active)
+            self.addCleanup(trigger.profiler.stop)
+
+            os.kill(os.getpid(), signal.SIGUSR2)
+            self.assertTrue(wait_for(lambda: self.files(".pstats")))
+            self.assertTrue(trigger.profiler.active)
+
+        def test_busy_profiler_skips_snapshot(self):
+            trigger = SignalTrigger("test", self.lines.append, modes="cpu", seconds=30, directory=self.dir)
+            trigger.profiler = Profiler("test", {"cpu"}, self.dir, self.lines.append).start()
+            self.addCleanup(trigger.profiler.stop)
+            with trigger.profiler.lock:
+                trigger.handle(signal.SIGUSR2, None)
+            self.assertEqual(self.lines[-1], "profiler busy, snapshot skipped")
+
+        def test_setup_profiles_from_arguments(self):
+            parser = argparse.ArgumentParser()
+            add_arguments(parser)
+            args = parser.parse_args(["--profile", "mem", "--profile-seconds", "5", "--profile-dir", self.dir])
+            for signum in (signal.SIGUSR2, signal.SIGTERM):
+                self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+            trigger = setup("test", args, self.lines.append)
+            self.addCleanup(atexit.unregister, trigger.profiler.stop)
+            self.assertEqual(trigger.profiler.modes, {"mem"})
+            self.assertEqual(signal.getsignal(signal.SIGUSR2), trigger.handle)
+            self.assertEqual(signal.getsignal(signal.SIGTERM), exit_on_sigterm)
+            trigger.profiler.stop()
+            self.assertEqual(len(self.files("-memory.txt")), 1)
+
+        def test_rejects_unknown_mode(self):
+            with self.assertRaises(ValueError):
+                SignalTrigger("test", modes="io")
+
+    class TestStartup(unittest.TestCase):
+        def test_parses_importtime(self):
+            stderr = ("import time: self [us] | cumulative | imported package\n"
+                      "import time:       120 |        120 |   _json\n"
+                      "import time:       300 |        420 | json\n"
+                      "a script's own stderr\n")
+            self.assertEqual(parse_importtime(stderr), {"_json": 120, "json": 420 - 120})
+
+        def test_measures_fresh_interpreters(self):
+            report = measure_startup(["-c", "import json, os; os._exit(int(os.environ['CODE']))"], {"CODE": "3"}, runs=2)
+            self.assertEqual(report.exit_code, 3)
+            self.assertEqual(len(report.wall_ms), 2)
+            self.assertGreater(report.rss_kib, 1024)
+            self.assertEqual(report.loaded("json"), ["json", "json.decoder", "json.encoder", "json.scanner"])
+            self.assertEqual(report.loaded("tracemalloc"), [])
+            self.assertGreater(report.import_ms, 0)
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for tc in [TestProfiler, TestSignalTrigger, TestStartup]:
+        suite.addTests(loader.loadTestsFromTestCase(tc))
+    runner = unittest.TextTestRunner(verbosity=2)
+    result = runner.run(suite)
+    sys.exit(0 if result.wasSuccessful() else 1)
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Shared profiling switch for the turtle-harbor scripts")
+    parser.add_argument("--test", action="store_true", help="run embedded unit tests")
+    parser.add_argument("--startup", action="store_true", help="time each script's no-op run in fresh interpreters")
+    args = parser.parse_args()
+
+    if args.test:
+        run_tests()
+        return
+    if args.startup:
+        bench_startup()
+        return
+    parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
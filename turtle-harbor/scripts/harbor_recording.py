@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""harbor_recording.py - "a show is recording" signal between the recorder and jobs sharing the NAS.
+
+while radio-t-monitor writes a show it keeps <STATE_DIR>/<stream>-recording.json
+fresh: its pid, when it was updated, the mean and worst write() latency of the
+last few seconds, and how long a write still in progress has been blocked. jobs that share the NAS link, like the NFO generator,
+ask a RecorderGate before each unit of work. with no show recording it lets
+everything through; while one records it paces the job to YIELD_RATE items a
+second, and once the recorder's writes slow to YIELD_LATENCY_MS it tells the
+job to stop and leave the rest for its next run. a file not refreshed for
+STATUS_STALE_AFTER seconds, from a crashed recorder, is ignored.
+
+env vars:
+  STATE_DIR        - where the status files live (default: ./state next to the scripts)
+  YIELD_RATE       - work items per second a job may do while a show records (default: 2)
+  YIELD_LATENCY_MS - mean recorder write latency at which jobs stop (default: 200)
+
+usage:
+  python harbor_recording.py --test    # run embedded tests
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+
+STATE_DIR = os.environ.get("STATE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "state"))
+YIELD_RATE = float(os.environ.get("YIELD_RATE", "2"))
+YIELD_LATENCY_MS = float(os.environ.get("YIELD_LATENCY_MS", "200"))
+STATUS_SUFFIX = "-recording.json"
+STATUS_INTERVAL = 5.0
+STATUS_STALE_AFTER = 3 * STATUS_INTERVAL
+
+
+def status_path(directory: str, stream: str) -> str:
+    return os.path.join(directory, f"{stream}{STATUS_SUFFIX}")
+
+
+class RecorderActivity:
+    # recorder side: begin_write() and observe() around every write; the status
+    # file is rewritten at most once per interval with that interval's
+    # latencies. refresh() is for a timer on another thread, so the file stays
+    # fresh while a write blocks or the recorder waits to reconnect. One
+    # publish runs at a time and a second caller skips its turn rather than
+    # wait, so the recorder never queues behind the timer. Failing to write
+    # it never stops a recording, the file just goes stale
+    def __init__(self, path: str, interval: float = STATUS_INTERVAL, clock=time.time) -> None:
+        self.path = path
+        self.interval = interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.writing = threading.Lock()
+        self.closed = False
+        self.published = float("-inf")
+        self.writes = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.write_started: float | None = None
+
+    def start(self) -> "RecorderActivity":
+        # raised before the first write, so jobs already yield while it connects
+        self.publish(self.clock())
+        return self
+
+    def begin_write(self) -> None:
+        self.write_started = self.clock()
+
+    def observe(self, seconds: float) -> None:
+        with self.lock:
+            self.write_started = None
+            self.writes += 1
+            self.total += seconds
+            self.worst = max(self.worst, seconds)
+            due = self.clock() - self.published >= self.interval
+        if due:
+            self.publish(self.clock())
+
+    def refresh(self) -> None:
+        now = self.clock()
+        if now - self.published >= self.interval:
+            self.publish(now)
+
+    def publish(self, now: float) -> None:
+        if self.closed or not self.writing.acquire(blocking=False):
+            return
+        try:
+            with self.lock:
+                started = self.write_started
+                status = {
+                    "pid": os.getpid(),
+                    "updated": now,
+                    "writes": self.writes,
+                    "write_ms_avg": round(self.total / self.writes * 1000, 3) if self.writes else 0.0,
+                    "write_ms_max": round(self.worst * 1000, 3),
+                    "write_ms_in_flight": round(max(now - started, 0.0) * 1000, 3) if started is not None else 0.0,
+                }
+                self.published = now
+                self.writes, self.total, self.worst = 0, 0.0, 0.0
+            tmp = f"{self.path}.tmp"
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump(status, f)
+            os.replace(tmp, self.path)
+            if self.closed:
+                # close() ran while this was writing; don't leave a signal behind
+                self.close()
+        except OSError:
+            pass
+        finally:
+            self.writing.release()
+
+    def close(self) -> None:
+        self.closed = True
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def read_activity(directory: str, now: float) -> dict[str, dict]:
+    # fresh status files by stream name
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return {}
+    active = {}
+    for name in names:
+        if not name.endswith(STATUS_SUFFIX):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if isinstance(status, dict) and now - status.get("updated", 0) <= STATUS_STALE_AFTER:
+            active[name.removesuffix(STATUS_SUFFIX)] = status
+    return active
+
+
+class RecorderGate:
+    # job side: admit() before each unit of non-urgent work. The status files
+    # are re-read at most once per STATUS_INTERVAL, so asking is cheap
+    def __init__(self, directory: str | None = None, rate: float | None = None, latency_ms: float | None = None,
+                 clock=time.time, sleep=time.sleep) -> None:
+        self.directory = directory or STATE_DIR
+        self.rate = rate or YIELD_RATE
+        self.latency_ms = latency_ms or YIELD_LATENCY_MS
+        self.clock = clock
+        self.sleep = sleep
+        self.checked = float("-inf")
+        self.active: dict[str, dict] = {}
+        self.last_admitted = float("-inf")
+        self.waited = 0.0
+
+    def recording(self) -> dict[str, dict]:
+        now = self.clock()
+        if now - self.checked >= STATUS_INTERVAL:
+            self.active = read_activity(self.directory, now)
+            self.checked = now
+        return self.active
+
+    def write_ms(self) -> float:
+        # a write still blocked on the NAS counts as slow as it has been so far
+        return max((max(status.get("write_ms_avg", 0.0), status.get("write_ms_in_flight", 0.0))
+                    for status in self.active.values()), default=0.0)
+
+    def admit(self) -> bool:
+        if not self.recording():
+            return True
+        if self.write_ms() >= self.latency_ms:
+            return False
+        now = self.clock()
+        delay = self.last_admitted + 1 / self.rate - now
+        if delay > 0:
+            self.sleep(delay)
+            self.waited += delay
+            now += delay
+        self.last_admitted = now
+        return True
+
+
+def run_tests() -> None:
+    import tempfile
+    import unittest
+    from unittest.mock import patch
+
+    class FakeClock:
+        def __init__(self, now: float = 1_000_000.0) -> None:
+            self.now = now
+            self.slept: list[float] = []
+
+        def time(self) -> float:
+            return self.now
+
+        def sleep(self, seconds: float) -> None:
+            self.slept.append(seconds)
+            self.now += seconds
+
+    class StatusTestCase(unittest.TestCase):
+        def setUp(self):
+            tmp = tempfile.TemporaryDirectory()
+            self.addCleanup(tmp.cleanup)
+            self.dir = tmp.name
+            self.clock = FakeClock()
+
+        def activity(self, stream: str = "radio-t") -> RecorderActivity:
+            return RecorderActivity(status_path(self.dir, stream), clock=self.clock.time)
+
+        def gate(self, **kwargs) -> RecorderGate:
+            return RecorderGate(self.dir, clock=self.clock.time, sleep=self.clock.sleep, **kwargs)
+
+    class TestRecorderActivity(StatusTestCase):
+        def test_publishes_once_per_interval(self):
+            activity = self.activity()
+            activity.observe(0.002)
+            with open(activity.path) as f:
+                first = json.load(f)
+            self.assertEqual((first["writes"], first["write_ms_avg"], first["pid"]), (1, 2.0, os.getpid()))
+
+            self.clock.now += 1
+            activity.observe(0.010)
+            activity.observe(0.030)
+            with open(activity.path) as f:
+                self.assertEqual(json.load(f), first)
+
+            self.clock.now += STATUS_INTERVAL
+            activity.observe(0.020)
+            with open(activity.path) as f:
+                status = json.load(f)
+            self.assertEqual((status["writes"], status["write_ms_avg"], status["write_ms_max"]), (3, 20.0, 30.0))
+
+        def test_start_publishes_before_any_write(self):
+            activity = self.activity().start()
+            with open(activity.path) as f:
+                status = json.load(f)
+            self.assertEqual((status["writes"], status["write_ms_avg"], status["updated"]), (0, 0.0, self.clock.now))
+            self.assertEqual(list(read_activity(self.dir, self.clock.now)), ["radio-t"])
+
+        def test_refresh_keeps_a_blocked_write_fresh(self):
+            activity = self.activity().start()
+            activity.begin_write()
+            self.clock.now += 1
+            activity.refresh()
+            with open(activity.path) as f:
+                self.assertEqual(json.load(f)["write_ms_in_flight"], 0.0)
+
+            self.clock.now += STATUS_STALE_AFTER
+            activity.refresh()
+            with open(activity.path) as f:
+                status = json.load(f)
+            self.assertEqual((status["writes"], status["write_ms_in_flight"]), (0, (1 + STATUS_STALE_AFTER) * 1000))
+            self.assertEqual(list(read_activity(self.dir, self.clock.now)), ["radio-t"])
+
+            activity.observe(1 + STATUS_STALE_AFTER)
+            self.clock.now += STATUS_INTERVAL
+            activity.refresh()
+            with open(activity.path) as f:
+                self.assertEqual(json.load(f)["write_ms_in_flight"], 0.0)
+
+        def test_close_removes_the_file(self):
+            activity = self.activity().start()
+            activity.observe(0.001)
+            activity.close()
+            activity.close()
+            self.assertEqual(os.listdir(self.dir), [])
+
+        def blocked_publish(self, activity: RecorderActivity) -> tuple[threading.Thread, threading.Event]:
+            # a publish from another thread, stuck writing the file until released
+            entered, release = threading.Event(), threading.Event()
+            dump = json.dump
+
+            def slow_dump(obj, f):
+                entered.set()
+                release.wait(5)
+                dump(obj, f)
+
+            patcher = patch("json.dump", slow_dump)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+            writer = threading.Thread(target=activity.publish, args=(self.clock.now,))
+            writer.start()
+            self.assertTrue(entered.wait(5))
+            return writer, release
+
+        def test_publish_skips_while_another_writes(self):
+            activity = self.activity()
+            writer, release = self.blocked_publish(activity)
+            activity.publish(self.clock.now + 1)
+            release.set()
+            writer.join(5)
+            self.assertEqual(sorted(os.listdir(self.dir)), ["radio-t-recording.json"])
+            with open(activity.path) as f:
+                self.assertEqual(json.load(f)["updated"], self.clock.now)
+
+        def test_close_during_a_publish_removes_the_file(self):
+            activity = self.activity()
+            writer, release = self.blocked_publish(activity)
+            activity.close()
+            release.set()
+            writer.join(5)
+            activity.publish(self.clock.now + STATUS_INTERVAL)
+            self.assertEqual(os.listdir(self.dir), [])
+
+        def test_unwritable_directory_is_ignored(self):
+            blocker = os.path.join(self.dir, "not-a-directory")
+            open(blocker, "w").close()
+            activity = RecorderActivity(status_path(blocker, "radio-t"), clock=self.clock.time)
+            activity.observe(0.001)
+            self.assertEqual(os.listdir(self.dir), ["not-a-directory"])
+
+    class TestRecorderGate(StatusTestCase):
+        def test_admits_everything_without_a_recording(self):
+            gate = self.gate()
+            self.assertTrue(all(gate.admit() for _ in range(100)))
+            self.assertEqual(self.clock.slept, [])
+
+        def test_paces_while_recording(self):
+            self.activity().observe(0.005)
+            gate = self.gate(rate=2)
+            for _ in range(5):
+                self.assertTrue(gate.admit())
+            self.assertEqual(self.clock.slept, [0.5] * 4)
+            self.assertEqual(gate.waited, 2.0)
+            self.assertEqual(list(gate.active), ["radio-t"])
+
+        def test_stops_when_recorder_writes_slow_down(self):
+            activity = self.activity()
+            activity.observe(0.005)
+            gate = self.gate(latency_ms=100)
+            self.assertTrue(gate.admit())
+
+            self.clock.now += STATUS_INTERVAL
+            activity.observe(0.150)
+            self.assertFalse(gate.admit())
+            self.assertEqual(gate.write_ms(), 150.0)
+
+        def test_stops_while_a_recorder_write_is_blocked(self):
+            activity = self.activity()
+            activity.begin_write()
+            self.clock.now += 0.5
+            activity.publish(self.clock.now)
+            gate = self.gate(latency_ms=100)
+            self.assertFalse(gate.admit())
+            self.assertEqual(gate.write_ms(), 500.0)
+
+        def test_ignores_stale_and_broken_files(self):
+            self.activity().observe(0.500)
+            with open(status_path(self.dir, "broken"), "w") as f:
+                f.write("{")
+            self.clock.now += STATUS_STALE_AFTER + 1
+            gate = self.gate(latency_ms=100)
+            self.assertTrue(gate.admit())
+            self.assertEqual(gate.active, {})
+            self.assertEqual(read_activity(os.path.join(self.dir, "missing"), self.clock.now), {})
+
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for tc in [TestRecorderActivity, TestRecorderGate]:
+        suite.addTests(loader.loadTestsFromTestCase(tc))
+    runner = unittest.TextTestRunner(verbosity=2)
+    result = runner.run(suite)
+    sys.exit(0 if result.wasSuccessful() else 1)
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Recording-active signal shared by the turtle-harbor scripts")
+    parser.add_argument("--test", action="store_true", help="run embedded unit tests")
+    args = parser.parse_args()
+
+    if args.test:
+        run_tests()
+        return
+    parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
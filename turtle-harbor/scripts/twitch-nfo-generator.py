@@ -6,36 +6,52 @@ matching NFO files compatible with XBMCnfoMoviesImporter plugin.
 
 env vars:
   TWITCH_DIR - root directory of twitch recordings (default: /mnt/nas/twitch)
+  LOKI_URL   - push structured logs to Loki as well, see harbor_log.py
+  YIELD_RATE - NFOs per second while radio-t-monitor records a show, see harbor_recording.py
+  AUDIT_WORKERS - threads checking NFOs in --audit (default: 16)
+  REBUILD_FILES_PER_SECOND - NFOs rewritten per second in --rebuild (default: 20)
+  REBUILD_MB_PER_SECOND    - MB read and written per second in --rebuild (default: 4)
 
 usage:
   TWITCH_DIR=/mnt/nas/twitch python twitch-nfo-generator.py    # generate NFOs
+  python twitch-nfo-generator.py --profile all                  # also write cProfile/tracemalloc output, see harbor_profile.py
+  python twitch-nfo-generator.py --audit                        # check every existing NFO, regenerate broken ones
+  python twitch-nfo-generator.py --rebuild                      # rewrite existing NFOs in the current format, newest first
+  python twitch-nfo-generator.py --bench memory                 # recording table vs a dict of Paths, 10k-1M entries
+  python twitch-nfo-generator.py --bench audit                  # audit throughput on a synthetic library
   python twitch-nfo-generator.py --test                         # run embedded tests
 """
 
 import json
 import os
 import sys
-import xml.etree.ElementTree as ET
-import xml.dom.minidom as minidom
+import time
+from array import array
 from datetime import datetime, timezone
 from pathlib import Path
 
+import harbor_log
+import harbor_profile
+import harbor_recording
+
 
 TWITCH_DIR = os.environ.get("TWITCH_DIR", "/mnt/nas/twitch")
+AUDIT_WORKERS = int(os.environ.get("AUDIT_WORKERS", "16"))
+AUDIT_PEEK = 4096
+AUDIT_MIN_BYTES = 200
+AUDIT_PROGRESS_INTERVAL = 10
+REBUILD_FILES_PER_SECOND = float(os.environ.get("REBUILD_FILES_PER_SECOND", "20"))
+REBUILD_MB_PER_SECOND = float(os.environ.get("REBUILD_MB_PER_SECOND", "4"))
+REBUILD_BURST = 1.0
+REBUILD_SAVE_INTERVAL = 10
+REBUILD_STATE = "nfo-rebuild.json"
 
 
-def log(msg):
-    ts = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
-    print(f"[{ts}] {msg}", flush=True)
+LOG = harbor_log.Logger("twitch-nfo-generator")
 
 
-def find_info_files(root_dir):
-    results = []
-    for root, _, files in os.walk(root_dir):
-        for name in files:
-            if name.endswith("-info.json"):
-                results.append(Path(root) / name)
-    return results
+def log(msg, **fields):
+    LOG(msg, **fields)
 
 
 def nfo_path_for(info_path):
@@ -43,11 +59,128 @@ def nfo_path_for(info_path):
     return info_path.parent / f"{video_id}-video.nfo"
 
 
+STATUSES = ("pending", "done", "error")
+
+
+class RecordingTable:
+    # per-recording state in flat columns instead of a Path and a dict per
+    # recording, which costs ~1.2 KB each (python twitch-nfo-generator.py
+    # --bench memory). A row is one *-info.json: its directory, interned and
+    # stored once, its video id, mtime, size, a caller-defined 64-bit
+    # fingerprint (0 when unknown) and a status. by_id maps a video id to its
+    # newest row and same_id chains older rows with that id, which only exist
+    # if one id shows up in several directories; a lookup costs the same in a
+    # flat directory of thousands of recordings as in a small one. Each
+    # directory's rows are chained through next_in_dir from dir_head, so a
+    # directory needs no container of its own
+    def __init__(self):
+        self.dirs = []
+        self.dir_index = {}
+        self.dir_head = array("i")
+        self.dir_of = array("I")
+        self.next_in_dir = array("i")
+        self.by_id = {}
+        self.same_id = array("i")
+        self.video_ids = []
+        self.mtimes = array("d")
+        self.sizes = array("q")
+        self.fingerprints = array("Q")
+        self.statuses = array("B")
+
+    def __len__(self):
+        return len(self.statuses)
+
+    def add(self, info_path, mtime=0.0, size=0, fingerprint=0, status="pending"):
+        directory, name = os.path.split(os.fspath(info_path))
+        video_id = name.removesuffix("-info.json")
+        d = self.dir_index.get(directory)
+        if d is None:
+            directory = sys.intern(directory)
+            d = self.dir_index[directory] = len(self.dirs)
+            self.dirs.append(directory)
+            self.dir_head.append(-1)
+        row = self._find(d, video_id)
+        if row is None:
+            row = len(self.statuses)
+            self.dir_of.append(d)
+            self.next_in_dir.append(self.dir_head[d])
+            self.dir_head[d] = row
+            self.same_id.append(self.by_id.get(video_id, -1))
+            self.by_id[video_id] = row
+            self.video_ids.append(video_id)
+            self.mtimes.append(mtime)
+            self.sizes.append(size)
+            self.fingerprints.append(fingerprint)
+            self.statuses.append(STATUSES.index(status))
+        else:
+            self.mtimes[row], self.sizes[row], self.fingerprints[row] = mtime, size, fingerprint
+            self.statuses[row] = STATUSES.index(status)
+        return row
+
+    def _find(self, d, video_id):
+        row = self.by_id.get(video_id, -1)
+        while row != -1:
+            if self.dir_of[row] == d:
+                return row
+            row = self.same_id[row]
+        return None
+
+    def find(self, info_path):
+        directory, name = os.path.split(os.fspath(info_path))
+        d = self.dir_index.get(directory)
+        return None if d is None else self._find(d, name.removesuffix("-info.json"))
+
+    def in_dir(self, directory):
+        d = self.dir_index.get(os.fspath(directory))
+        rows = []
+        row = -1 if d is None else self.dir_head[d]
+        while row != -1:
+            rows.append(row)
+            row = self.next_in_dir[row]
+        return rows[::-1]
+
+    def path(self, row):
+        return Path(self.dirs[self.dir_of[row]]) / f"{self.video_ids[row]}-info.json"
+
+    def status(self, row):
+        return STATUSES[self.statuses[row]]
+
+    def set_status(self, row, status):
+        self.statuses[row] = STATUSES.index(status)
+
+    def with_status(self, status):
+        code = STATUSES.index(status)
+        return [row for row, s in enumerate(self.statuses) if s == code]
+
+
+def scan_recordings(root_dir, stat=False):
+    # one walk; a recording is done when its NFO is in the same listing, so
+    # only stat=True (mtime and size) costs a syscall per recording
+    table = RecordingTable()
+    for root, _, files in os.walk(root_dir):
+        names = set(files)
+        for name in files:
+            if not name.endswith("-info.json"):
+                continue
+            path = os.path.join(root, name)
+            mtime, size = 0.0, 0
+            if stat:
+                st = os.stat(path)
+                mtime, size = st.st_mtime, st.st_size
+            done = f"{name.removesuffix('-info.json')}-video.nfo" in names
+            table.add(path, mtime, size, status="done" if done else "pending")
+    return table
+
+
 def load_json(path):
+    return decode_json(path.read_bytes())
+
+
+def decode_json(raw):
     try:
-        return json.loads(path.read_text(encoding="utf-8"))
+        return json.loads(raw.decode("utf-8"))
     except UnicodeDecodeError:
-        return json.loads(path.read_text(encoding="latin-1"))
+        return json.loads(raw.decode("latin-1"))
 
 
 def extract_date(data, info_path):
@@ -128,7 +261,11 @@ def unique_games(data):
     return sorted({ch["title"] for ch in chapters if ch.get("title")})
 
 
-def build_nfo_xml(data, info_path):
+def build_nfo_xml(data, info_path, date_added=None):
+    # imported here: an hourly run with nothing new never loads them
+    import xml.etree.ElementTree as ET
+    import xml.dom.minidom as minidom
+
     title = data.get("title", "Unknown Title")
     user_name = data.get("user_name", "Unknown User")
     description = data.get("description", "")
@@ -175,7 +312,7 @@ def build_nfo_xml(data, info_path):
     if thumb:
         ET.SubElement(movie, "thumb").text = thumb
 
-    ET.SubElement(movie, "dateadded").text = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    ET.SubElement(movie, "dateadded").text = date_added or datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
 
     chapters = data.get("chapters")
     if chapters:
@@ -206,43 +343,461 @@ def build_nfo_xml(data, info_path):
     return xml_decl + body
 
 
-def generate_nfo(info_path):
+def generate_nfo(info_path, overwrite=False):
     output = nfo_path_for(info_path)
-    if output.exists():
+    if output.exists() and not overwrite:
         return False
 
     data = load_json(info_path)
-    xml_content = build_nfo_xml(data, info_path)
-    output.write_text(xml_content, encoding="utf-8")
+    write_nfo(output, build_nfo_xml(data, info_path).encode("utf-8"))
     return True
 
 
+def write_nfo(output, content):
+    # written aside and renamed: an interrupted write never leaves a half NFO behind
+    partial = output.with_name(output.name + ".partial")
+    partial.write_bytes(content)
+    os.replace(partial, output)
+
+
+def audit_nfo(path):
+    # None for a sound NFO, otherwise why it is broken. Head and tail decide
+    # most files in one or two reads; only odd ones get a full streaming parse
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            head = f.read(AUDIT_PEEK)
+            tail = head
+            if size > len(head):
+                f.seek(max(size - AUDIT_PEEK, len(head)))
+                tail = f.read()
+    except OSError as e:
+        return f"unreadable: {e.strerror}"
+    if not head:
+        return "empty"
+    if not head.lstrip().startswith(b"<?xml") or b"<movie" not in head:
+        return "no <movie> header"
+    if b"</movie>" not in tail:
+        return "truncated"
+    if size < AUDIT_MIN_BYTES or b"\0" in head or b"\0" in tail or not tail.rstrip().endswith(b"</movie>"):
+        return parse_nfo(path)
+    return None
+
+
+def parse_nfo(path):
+    import xml.etree.ElementTree as ET
+
+    try:
+        titled = False
+        for _, element in ET.iterparse(path, events=("end",)):
+            titled = titled or element.tag == "title" and bool(element.text)
+        if element.tag != "movie":
+            return f"root is <{element.tag}>"
+        return None if titled else "no title"
+    except ET.ParseError as e:
+        return f"invalid XML: {e}"
+    except OSError as e:
+        return f"unreadable: {e.strerror}"
+
+
+def audit_nfos(table, rows, workers, gate):
+    # checks NFOs on a thread pool, a few per worker in flight; the gate is
+    # asked before each one is queued. Returns broken (row, reason) pairs,
+    # the number checked and the number left unchecked
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    broken = []
+    audited = 0
+    deferred = 0
+    started = last_progress = time.monotonic()
+
+    def collect(done):
+        nonlocal audited
+        for future in done:
+            row = running.pop(future)
+            reason = future.result()
+            audited += 1
+            if reason is not None:
+                broken.append((row, reason))
+
+    with ThreadPoolExecutor(workers) as pool:
+        running = {}
+        for i, row in enumerate(rows):
+            if not gate.admit():
+                deferred = len(rows) - i
+                break
+            running[pool.submit(audit_nfo, nfo_path_for(table.path(row)))] = row
+            if len(running) >= workers * 4:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                collect(done)
+            now = time.monotonic()
+            if now - last_progress >= AUDIT_PROGRESS_INTERVAL:
+                log(f"audited {audited}/{len(rows)} NFOs, {audited / (now - started):.0f} files/s")
+                last_progress = now
+        collect(wait(running).done)
+    return broken, audited, deferred
+
+
+def audit():
+    root = Path(TWITCH_DIR)
+    if not root.is_dir():
+        log(f"twitch directory not found: {root}")
+        sys.exit(1)
+
+    harbor_log.bind(phase="scan")
+    log(f"scanning {root}")
+    table = scan_recordings(root)
+    rows = table.with_status("done")
+
+    harbor_log.bind(phase="audit")
+    gate = harbor_recording.RecorderGate()
+    workers = AUDIT_WORKERS
+    if gate.recording():
+        workers = 1
+        log(f"a show is recording, auditing with 1 worker at {gate.rate:g} files/s")
+    log(f"auditing {len(rows)} NFOs with {workers} workers")
+    started = time.monotonic()
+    broken, audited, deferred = audit_nfos(table, rows, workers, gate)
+    elapsed = time.monotonic() - started
+    rate = audited / elapsed if elapsed > 0 else 0.0
+    log(f"audited {audited} NFOs in {elapsed:.1f}s, {rate:.0f} files/s, {len(broken)} broken",
+        audited=audited, broken=len(broken), files_per_second=round(rate, 1))
+
+    harbor_log.bind(phase="generate")
+    regenerated = errors = 0
+    for i, (row, reason) in enumerate(broken):
+        info_path = table.path(row)
+        output = nfo_path_for(info_path)
+        if not gate.admit():
+            deferred += len(broken) - i
+            break
+        log(f"broken {output.name}: {reason}", level="warning", file=str(output), reason=reason)
+        try:
+            generate_nfo(info_path, overwrite=True)
+            regenerated += 1
+        except Exception as e:
+            log(f"error regenerating {output.name}: {e}", level="error", file=str(output))
+            errors += 1
+
+    log(f"audit done: {len(broken)} broken, {regenerated} regenerated, {errors} errors"
+        + (f", {deferred} deferred to a show recording" if deferred else ""),
+        broken=len(broken), regenerated=regenerated, errors=errors, deferred=deferred)
+
+
+def nfo_date_added(content):
+    start = content.find(b"<dateadded>")
+    end = content.find(b"</dateadded>", start)
+    if start == -1 or end == -1:
+        return None
+    return content[start + len(b"<dateadded>"):end].decode("utf-8", "replace") or None
+
+
+def rebuild_nfo(info_path):
+    # rewrites an NFO in the current format. Its dateadded is kept, so the
+    # bytes only change with the format or the info.json, and Plex's recently
+    # added order stays put. Returns "rewritten" or "unchanged" and the bytes
+    # read and written
+    output = nfo_path_for(info_path)
+    try:
+        old = output.read_bytes()
+    except FileNotFoundError:
+        old = b""
+    raw = info_path.read_bytes()
+    new = build_nfo_xml(decode_json(raw), info_path, nfo_date_added(old)).encode("utf-8")
+    if new == old:
+        return "unchanged", len(raw) + len(old)
+    write_nfo(output, new)
+    return "rewritten", len(raw) + len(old) + len(new)
+
+
+def rebuild_order(table, cursor=None):
+    # rows with an NFO, newest premiere first, as (date, path) keys. The date
+    # comes from the directory name, as Ganymede names them, or from the
+    # info.json for the few without one. Keys not below the cursor were done
+    # by an earlier run, or are new recordings the hourly run wrote already
+    keys = []
+    for row in table.with_status("done"):
+        info_path = table.path(row)
+        premiere_date = extract_date({}, info_path)[0]
+        if not premiere_date:
+            try:
+                premiere_date = extract_date(load_json(info_path), info_path)[0]
+            except (OSError, ValueError):
+                pass
+        key = (premiere_date, str(info_path))
+        if cursor is None or key < cursor:
+            keys.append((key, row))
+    keys.sort(reverse=True)
+    return keys
+
+
+class Throttle:
+    # caps a batch at files/s and bytes/s: pace() after each file sleeps until
+    # its cost is paid, with up to REBUILD_BURST seconds of credit from files
+    # that took longer than their share
+    def __init__(self, files_per_second, bytes_per_second, clock=time.monotonic, sleep=time.sleep):
+        self.files_per_second = files_per_second
+        self.bytes_per_second = bytes_per_second
+        self.clock = clock
+        self.sleep = sleep
+        self.due = float("-inf")
+        self.waited = 0.0
+
+    def pace(self, size):
+        cost = max(1 / self.files_per_second if self.files_per_second > 0 else 0.0,
+                   size / self.bytes_per_second if self.bytes_per_second > 0 else 0.0)
+        now = self.clock()
+        self.due = max(self.due, now - REBUILD_BURST) + cost
+        if self.due > now:
+            self.sleep(self.due - now)
+            self.waited += self.due - now
+
+
+def rebuild_state_path():
+    return os.path.join(harbor_recording.STATE_DIR, REBUILD_STATE)
+
+
+def load_rebuild_state(root):
+    # the unfinished pass over root, or a new one
+    fresh = {"root": root, "cursor": None, "runs": 0, "rewritten": 0, "unchanged": 0, "errors": 0}
+    try:
+        with open(rebuild_state_path()) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return fresh
+    except (OSError, ValueError) as e:
+        log(f"ignoring unreadable rebuild progress {rebuild_state_path()}: {e}", level="warning")
+        return fresh
+    if not isinstance(state, dict) or state.get("root") != root:
+        return fresh
+    return {**fresh, **state}
+
+
+def save_rebuild_state(state):
+    path = rebuild_state_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        log(f"failed to save rebuild progress {path}: {e}", level="error")
+
+
+def rebuild():
+    root = Path(TWITCH_DIR)
+    if not root.is_dir():
+        log(f"twitch directory not found: {root}")
+        sys.exit(1)
+
+    harbor_log.bind(phase="scan")
+    log(f"scanning {root}")
+    table = scan_recordings(root)
+    state = load_rebuild_state(str(root))
+    order = rebuild_order(table, tuple(state["cursor"]) if state["cursor"] else None)
+    state["runs"] += 1
+    log(f"rebuilding {len(order)} NFOs newest first, at most {REBUILD_FILES_PER_SECOND:g} files/s and "
+        f"{REBUILD_MB_PER_SECOND:g} MB/s" + (f", resuming after {state['runs'] - 1} earlier runs" if state["cursor"] else ""))
+
+    harbor_log.bind(phase="rebuild")
+    gate = harbor_recording.RecorderGate()
+    throttle = Throttle(REBUILD_FILES_PER_SECOND, REBUILD_MB_PER_SECOND * 1_000_000)
+    counts = {"rewritten": 0, "unchanged": 0, "errors": 0}
+    deferred = 0
+    finished = False
+    moved_total = 0
+    started = saved = time.monotonic()
+    try:
+        for i, (key, row) in enumerate(order):
+            if not gate.admit():
+                deferred = len(order) - i
+                log(f"recorder writes at {gate.write_ms():.0f}ms, leaving {deferred} NFOs for the next --rebuild",
+                    level="warning", deferred=deferred)
+                break
+            info_path = table.path(row)
+            output = nfo_path_for(info_path)
+            moved = 0
+            try:
+                outcome, moved = rebuild_nfo(info_path)
+                if outcome == "rewritten":
+                    log(f"rewrote {output.name}", file=str(output))
+            except Exception as e:
+                log(f"error rebuilding {output.name}: {e}", level="error", file=str(output))
+                outcome = "errors"
+            counts[outcome] += 1
+            state[outcome] += 1
+            state["cursor"] = list(key)
+            moved_total += moved
+            throttle.pace(moved)
+            now = time.monotonic()
+            if now - saved >= REBUILD_SAVE_INTERVAL:
+                save_rebuild_state(state)
+                log(f"rebuilt {i + 1}/{len(order)} NFOs, {(i + 1) / (now - started):.1f} files/s, "
+                    f"{moved_total / (now - started) / 1_000_000:.2f} MB/s")
+                saved = now
+        else:
+            finished = True
+    finally:
+        if finished:
+            try:
+                os.remove(rebuild_state_path())
+            except FileNotFoundError:
+                pass
+        else:
+            save_rebuild_state(state)
+
+    log(f"rebuild done: {counts['rewritten']} rewritten, {counts['unchanged']} unchanged, {counts['errors']} errors"
+        + (f", {deferred} deferred" if deferred else ""), deferred=deferred, **counts)
+    if finished and state["runs"] > 1:
+        log(f"rebuild pass complete after {state['runs']} runs: {state['rewritten']} rewritten, "
+            f"{state['unchanged']} unchanged, {state['errors']} errors")
+
+
 def run():
     root = Path(TWITCH_DIR)
     if not root.is_dir():
         log(f"twitch directory not found: {root}")
         sys.exit(1)
 
+    harbor_log.bind(phase="scan")
     log(f"scanning {root}")
-    info_files = find_info_files(root)
-    log(f"found {len(info_files)} info files")
+    table = scan_recordings(root)
+    pending = table.with_status("pending")
+    log(f"found {len(table)} info files, {len(pending)} without NFO")
 
     created = 0
-    skipped = 0
+    skipped = len(table) - len(pending)
     errors = 0
-
-    for info_path in info_files:
+    deferred = 0
+
+    harbor_log.bind(phase="generate")
+    # the recorder shares the NAS link: pace while a show records and stop
+    # when its writes slow down; the next hourly run picks up the rest
+    gate = harbor_recording.RecorderGate()
+    for i, row in enumerate(pending):
+        if not gate.admit():
+            deferred = len(pending) - i
+            log(f"recorder writes at {gate.write_ms():.0f}ms, leaving {deferred} NFOs for the next run",
+                level="warning", deferred=deferred)
+            break
+        info_path = table.path(row)
         try:
             if generate_nfo(info_path):
-                log(f"created {nfo_path_for(info_path).name}")
+                log(f"created {nfo_path_for(info_path).name}", file=str(nfo_path_for(info_path)))
                 created += 1
             else:
                 skipped += 1
+            table.set_status(row, "done")
         except Exception as e:
-            log(f"error processing {info_path.name}: {e}")
+            log(f"error processing {info_path.name}: {e}", level="error", file=str(info_path))
+            table.set_status(row, "error")
             errors += 1
 
-    log(f"done: {created} created, {skipped} skipped, {errors} errors")
+    if gate.waited:
+        log(f"yielded {gate.waited:.0f}s to a show recording")
+    log(f"done: {created} created, {skipped} skipped, {errors} errors" + (f", {deferred} deferred" if deferred else ""),
+        created=created, skipped=skipped, errors=errors, deferred=deferred)
+
+
+def synthetic_info_paths(count, channels=200, root=TWITCH_DIR, flat=False):
+    # Ganymede's layout: <channel>/<date>-<video id>/<video id>-info.json, or
+    # with flat every recording straight in one channel directory
+    for i in range(count):
+        video_id = 2_000_000_000 + i
+        if flat:
+            yield f"{root}/channel0/{video_id}-info.json"
+        else:
+            yield f"{root}/channel{i % channels}/2025-{i % 12 + 1:02d}-{i % 28 + 1:02d}-{video_id}/{video_id}-info.json"
+
+
+def bench_memory(sizes=(10_000, 100_000, 1_000_000), lookups=100_000):
+    import gc
+    import random
+    import tracemalloc
+
+    def naive(paths):
+        recordings = {}
+        for i, p in enumerate(paths):
+            recordings[Path(p)] = {"mtime": 1.7e9 + i, "size": 4096 + i, "fingerprint": 2**60 + i, "status": "pending"}
+        return recordings
+
+    def compact(paths):
+        table = RecordingTable()
+        for i, p in enumerate(paths):
+            table.add(p, 1.7e9 + i, 4096 + i, 2**60 + i)
+        return table
+
+    def measure(build, paths, probe):
+        # build once untraced for the time, once under tracemalloc for the bytes
+        gc.collect()
+        started = time.perf_counter()
+        built = build(paths)
+        build_s = time.perf_counter() - started
+        started = time.perf_counter()
+        for p in probe:
+            probe_lookup(built, p)
+        lookup_us = (time.perf_counter() - started) / len(probe) * 1e6
+        del built
+        gc.collect()
+        tracemalloc.start()
+        built = build(paths)
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del built
+        return used, build_s, lookup_us
+
+    def probe_lookup(built, p):
+        if isinstance(built, RecordingTable):
+            return built.find(p)
+        return built.get(Path(p))
+
+    print(f"{'entries':>9} {'layout':>7} {'dict of Paths':>15} {'table':>13} {'ratio':>6} {'build':>15} "
+          f"{'lookup by path':>17}")
+    rng = random.Random(7)
+    for n in sizes:
+        for flat in (False, True):
+            paths = list(synthetic_info_paths(n, flat=flat))
+            probe = rng.choices(paths, k=lookups)
+            naive_bytes, naive_s, naive_us = measure(naive, paths, probe)
+            table_bytes, table_s, table_us = measure(compact, paths, probe)
+            print(f"{n:>9} {'flat' if flat else 'nested':>7} {naive_bytes / 2**20:9.1f} MiB {table_bytes / 2**20:7.1f} MiB "
+                  f"{naive_bytes / table_bytes:5.1f}x {naive_s:6.2f}s/{table_s:5.2f}s {naive_us:6.2f}/{table_us:5.2f} us")
+            print(f"{'':>9} {'':>7} {naive_bytes / n:9.0f} B/e {table_bytes / n:7.0f} B/e")
+
+
+def bench_audit(count=20_000, broken_every=50):
+    # a synthetic library in a temp dir: mostly sound NFOs, every tenth one
+    # with enough chapters to need a head and a tail read, and every
+    # broken_every-th one truncated, zero-filled at the end or empty
+    import tempfile
+
+    data = {"title": "Bench stream", "user_name": "streamer", "created_at": "2025-06-01T20:00:00Z",
+            "duration": 7200, "description": "x" * 300}
+    small = build_nfo_xml(data, Path("2000000000-info.json")).encode()
+    data["chapters"] = [{"start": i * 60, "title": f"Game {i}"} for i in range(150)]
+    large = build_nfo_xml(data, Path("2000000000-info.json")).encode()
+    damage = [lambda b: b[:len(b) // 2], lambda b: b[:-256] + b"\0" * 256, lambda b: b""]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        table = RecordingTable()
+        planted = 0
+        for i, info in enumerate(synthetic_info_paths(count, root=tmp)):
+            os.makedirs(os.path.dirname(info), exist_ok=True)
+            content = large if i % 10 == 0 else small
+            if i % broken_every == broken_every - 1:
+                content = damage[planted % len(damage)](content)
+                planted += 1
+            nfo_path_for(Path(info)).write_bytes(content)
+            table.add(info, status="done")
+        rows = table.with_status("done")
+        print(f"{count} NFOs ({len(small)} and {len(large)} bytes), {planted} broken; page cache warm, "
+              f"so this is CPU cost, over NFS more workers hide round trips")
+        for workers in (1, 4, 16, 64):
+            gate = harbor_recording.RecorderGate(tmp)
+            started = time.monotonic()
+            broken, audited, _ = audit_nfos(table, rows, workers, gate)
+            elapsed = time.monotonic() - started
+            print(f"workers={workers:<3} {audited / elapsed:8.0f} files/s  {elapsed:5.2f}s  found {len(broken)}/{planted}")
 
 
 def run_tests():
@@ -378,25 +933,318 @@ def run_tests():
                 self.assertFalse(generate_nfo(info))
                 self.assertEqual(nfo.read_text(), "existing")
 
-    class TestFindInfoFiles(unittest.TestCase):
-        def test_finds_nested(self):
+        def test_overwrite_replaces_existing(self):
+            with tempfile.TemporaryDirectory() as tmp:
+                info = Path(tmp) / "vid-info.json"
+                info.write_text(json.dumps({"title": "Test"}))
+                nfo = Path(tmp) / "vid-video.nfo"
+                nfo.write_text("<?xml")
+
+                self.assertTrue(generate_nfo(info, overwrite=True))
+                self.assertIn("<title>Test</title>", nfo.read_text())
+                self.assertEqual(sorted(p.name for p in Path(tmp).iterdir()), ["vid-info.json", "vid-video.nfo"])
+
+    class TestRecordingTable(unittest.TestCase):
+        def test_lookup_by_path_and_directory(self):
+            table = RecordingTable()
+            a = table.add("/t/chan/2025-01-01/a-info.json", 1.5, 10, 2**63 + 1)
+            b = table.add(Path("/t/chan/2025-01-01/b-info.json"), status="done")
+            c = table.add("/t/chan/2025-01-02/a-info.json")
+
+            self.assertEqual(table.find(Path("/t/chan/2025-01-01/a-info.json")), a)
+            self.assertEqual(table.find("/t/chan/2025-01-02/a-info.json"), c)
+            self.assertIsNone(table.find("/t/chan/2025-01-02/b-info.json"))
+            self.assertIsNone(table.find("/t/other/a-info.json"))
+            self.assertEqual(table.in_dir("/t/chan/2025-01-01"), [a, b])
+            self.assertEqual(table.in_dir(Path("/t/chan/2025-01-02")), [c])
+            self.assertEqual(table.in_dir("/t/chan"), [])
+            self.assertEqual(table.path(b), Path("/t/chan/2025-01-01/b-info.json"))
+            self.assertEqual((table.mtimes[a], table.sizes[a], table.fingerprints[a]), (1.5, 10, 2**63 + 1))
+            self.assertEqual(table.with_status("pending"), [a, c])
+            self.assertEqual(len(table.dirs), 2)
+
+        def test_add_updates_existing_row(self):
+            table = RecordingTable()
+            row = table.add("/t/a-info.json", 1.0, 5)
+            self.assertEqual(table.add("/t/a-info.json", 2.0, 6, status="error"), row)
+            self.assertEqual(len(table), 1)
+            self.assertEqual((table.mtimes[row], table.sizes[row], table.status(row)), (2.0, 6, "error"))
+            table.set_status(row, "done")
+            self.assertEqual(table.with_status("done"), [row])
+            with self.assertRaises(ValueError):
+                table.set_status(row, "unknown")
+
+        def test_interns_directories(self):
+            table = RecordingTable()
+            table.add("/t/" + "chan" + "/a-info.json")
+            table.add("/t/" + "chan" + "/b-info.json")
+            self.assertIs(table.dirs[table.dir_of[0]], table.dirs[table.dir_of[1]])
+            self.assertIs(table.dirs[0], sys.intern("/t/chan"))
+
+        def test_smaller_than_dict_of_paths(self):
+            import tracemalloc
+
+            paths = list(synthetic_info_paths(10_000))
+            tracemalloc.start()
+            table = RecordingTable()
+            for p in paths:
+                table.add(p, 1.7e9, 4096, 2**60)
+            used = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            self.assertEqual(len(table), 10_000)
+            self.assertLess(used / len(table), 400)
+
+        def test_flat_directory_adds_in_linear_time(self):
+            paths = list(synthetic_info_paths(50_000, flat=True))
+            started = time.monotonic()
+            table = RecordingTable()
+            for p in paths:
+                table.add(p)
+            self.assertLess(time.monotonic() - started, 2.0)
+            self.assertEqual((len(table), len(table.dirs)), (50_000, 1))
+            self.assertEqual(table.find(paths[123]), 123)
+            self.assertEqual(len(table.in_dir(os.path.dirname(paths[0]))), 50_000)
+
+        def test_scan_marks_recordings_with_nfo_done(self):
             with tempfile.TemporaryDirectory() as tmp:
                 sub = Path(tmp) / "streamer" / "2025-01-01"
                 sub.mkdir(parents=True)
-                (sub / "abc-info.json").touch()
-                (sub / "abc-video.mp4").touch()
+                (sub / "abc-info.json").write_text("{}")
+                (sub / "abc-video.nfo").touch()
+                (sub / "def-info.json").write_text("{\"a\": 1}")
                 (sub / "other.txt").touch()
 
-                results = find_info_files(tmp)
-                self.assertEqual(len(results), 1)
-                self.assertTrue(results[0].name.endswith("-info.json"))
+                table = scan_recordings(tmp)
+                self.assertEqual(len(table), 2)
+                self.assertEqual(table.status(table.find(sub / "abc-info.json")), "done")
+                self.assertEqual(table.with_status("pending"), [table.find(sub / "def-info.json")])
+                self.assertEqual(table.sizes[0], 0)
+
+                stated = scan_recordings(tmp, stat=True)
+                row = stated.find(sub / "def-info.json")
+                self.assertEqual(stated.sizes[row], 8)
+                self.assertEqual(stated.mtimes[row], (sub / "def-info.json").stat().st_mtime)
+
+    class TestAudit(unittest.TestCase):
+        def setUp(self):
+            tmp = tempfile.TemporaryDirectory()
+            self.addCleanup(tmp.cleanup)
+            self.dir = Path(tmp.name)
+            data = {"title": "Test", "user_name": "user", "chapters": [{"start": i, "title": "g"} for i in range(400)]}
+            self.small = build_nfo_xml({"title": "Test"}, Path("a-info.json")).encode()
+            self.large = build_nfo_xml(data, Path("a-info.json")).encode()
+
+        def nfo(self, content, name="a"):
+            path = self.dir / f"{name}-video.nfo"
+            path.write_bytes(content)
+            return path
+
+        def test_sound_nfos_pass(self):
+            self.assertGreater(len(self.large), 2 * AUDIT_PEEK)
+            self.assertIsNone(audit_nfo(self.nfo(self.small)))
+            self.assertIsNone(audit_nfo(self.nfo(self.large)))
+            self.assertIsNone(audit_nfo(self.nfo(self.small + b"\n\n")))
+
+        def test_head_and_tail_catch_truncation(self):
+            self.assertEqual(audit_nfo(self.nfo(b"")), "empty")
+            self.assertEqual(audit_nfo(self.nfo(self.large[:len(self.large) // 2])), "truncated")
+            self.assertEqual(audit_nfo(self.nfo(self.small[:-5])), "truncated")
+            self.assertEqual(audit_nfo(self.nfo(self.large[:-256] + b"\0" * 256)), "truncated")
+            self.assertEqual(audit_nfo(self.nfo(b"\0" * 4096 + self.large[4096:])), "no <movie> header")
+            self.assertTrue(audit_nfo(self.dir / "missing-video.nfo").startswith("unreadable"))
+
+        def test_suspicious_files_are_parsed(self):
+            self.assertTrue(audit_nfo(self.nfo(self.small + b"<movie>")).startswith("invalid XML"))
+            self.assertTrue(audit_nfo(self.nfo(self.small.replace(b"<plot/>", b"\0" * 7))).startswith("invalid XML"))
+            self.assertEqual(audit_nfo(self.nfo(b'<?xml version="1.0"?><movie><plot/></movie>')), "no title")
+            self.assertIsNone(audit_nfo(self.nfo(b'<?xml version="1.0"?><movie><title>t</title></movie>')))
+
+        def test_regenerates_only_broken_nfos(self):
+            from unittest.mock import patch
+
+            for name in ("good", "cut"):
+                sub = self.dir / "twitch" / "streamer" / f"2025-01-01-{name}"
+                sub.mkdir(parents=True)
+                (sub / f"{name}-info.json").write_text('{"title": "Test"}')
+                generate_nfo(sub / f"{name}-info.json")
+            cut = self.dir / "twitch" / "streamer" / "2025-01-01-cut" / "cut-video.nfo"
+            cut.write_bytes(cut.read_bytes()[:100])
+            good = self.dir / "twitch" / "streamer" / "2025-01-01-good" / "good-video.nfo"
+            os.utime(good, (1, 1))
+
+            lines = []
+            with patch("__main__.TWITCH_DIR", str(self.dir / "twitch")), patch("harbor_recording.STATE_DIR", str(self.dir)), \
+                    patch("__main__.log", lambda msg, **fields: lines.append(msg)):
+                audit()
+            self.assertIsNone(audit_nfo(cut))
+            self.assertEqual(good.stat().st_mtime, 1)
+            self.assertIn("broken cut-video.nfo: truncated", lines)
+            self.assertEqual(lines[-1], "audit done: 1 broken, 1 regenerated, 0 errors")
+
+        def test_pool_checks_every_row(self):
+            table = RecordingTable()
+            for i in range(50):
+                info = self.dir / f"{i}-info.json"
+                self.nfo(self.small if i % 7 else self.small[:50], str(i))
+                table.add(info, status="done")
+            gate = harbor_recording.RecorderGate(str(self.dir))
+            broken, audited, deferred = audit_nfos(table, table.with_status("done"), 3, gate)
+            self.assertEqual((audited, deferred), (50, 0))
+            self.assertEqual(sorted(table.video_ids[row] for row, _ in broken), sorted(str(i) for i in range(0, 50, 7)))
+
+    class TestYieldToRecorder(unittest.TestCase):
+        def run_with_recorder(self, write_ms):
+            from unittest.mock import patch
+
+            with tempfile.TemporaryDirectory() as tmp:
+                sub = Path(tmp) / "twitch" / "streamer" / "2025-01-01"
+                sub.mkdir(parents=True)
+                for video_id in ("a", "b"):
+                    (sub / f"{video_id}-info.json").write_text('{"title": "t"}')
+                activity = harbor_recording.RecorderActivity(harbor_recording.status_path(tmp, "radio-t"))
+                activity.observe(write_ms / 1000)
+                lines = []
+                with patch("__main__.TWITCH_DIR", str(Path(tmp) / "twitch")), \
+                        patch("harbor_recording.STATE_DIR", tmp), patch("harbor_recording.YIELD_RATE", 1000), \
+                        patch("__main__.log", lambda msg, **fields: lines.append(msg)):
+                    run()
+                return sorted(p.name for p in sub.glob("*.nfo")), lines
+
+        def test_paces_while_recorder_keeps_up(self):
+            created, lines = self.run_with_recorder(5)
+            self.assertEqual(created, ["a-video.nfo", "b-video.nfo"])
+            self.assertEqual(lines[-1], "done: 2 created, 0 skipped, 0 errors")
+
+        def test_defers_when_recorder_writes_slow_down(self):
+            created, lines = self.run_with_recorder(500)
+            self.assertEqual(created, [])
+            self.assertIn("recorder writes at 500ms, leaving 2 NFOs for the next run", lines)
+            self.assertEqual(lines[-1], "done: 0 created, 0 skipped, 0 errors, 2 deferred")
+
+    class TestRebuild(unittest.TestCase):
+        def setUp(self):
+            from unittest.mock import patch
+
+            tmp = tempfile.TemporaryDirectory()
+            self.addCleanup(tmp.cleanup)
+            self.dir = Path(tmp.name)
+            self.infos = {}
+            for day, video_id in (("2025-03-01", "old"), ("2025-05-01", "new"), ("2025-04-01", "mid")):
+                sub = self.dir / "twitch" / "streamer" / f"{day}-{video_id}"
+                sub.mkdir(parents=True)
+                self.infos[video_id] = sub / f"{video_id}-info.json"
+                self.infos[video_id].write_text(json.dumps({"title": video_id}))
+            for name, value in (("__main__.TWITCH_DIR", str(self.dir / "twitch")),
+                                ("harbor_recording.STATE_DIR", str(self.dir / "state")),
+                                ("__main__.REBUILD_FILES_PER_SECOND", 0), ("__main__.REBUILD_MB_PER_SECOND", 0)):
+                patcher = patch(name, value)
+                patcher.start()
+                self.addCleanup(patcher.stop)
+
+        def rebuild(self):
+            from unittest.mock import patch
+
+            lines = []
+            with patch("__main__.log", lambda msg, **fields: lines.append(msg)):
+                rebuild()
+            return lines
+
+        def test_newest_first_keeping_dateadded(self):
+            from unittest.mock import patch
+
+            for info in self.infos.values():
+                generate_nfo(info)
+            old = nfo_path_for(self.infos["old"])
+            old.write_bytes(old.read_bytes().replace(b"<title>old</title>", b"<title>stale</title>"))
+            date_added = nfo_date_added(old.read_bytes())
+            os.utime(nfo_path_for(self.infos["new"]), (1, 1))
+
+            order = []
+            real = rebuild_nfo
+            with patch("__main__.rebuild_nfo", side_effect=lambda p: order.append(p.name) or real(p)):
+                lines = self.rebuild()
+            self.assertEqual(order, ["new-info.json", "mid-info.json", "old-info.json"])
+            self.assertIn("<title>old</title>", old.read_text())
+            self.assertEqual(nfo_date_added(old.read_bytes()), date_added)
+            self.assertEqual(nfo_path_for(self.infos["new"]).stat().st_mtime, 1)
+            self.assertIn("rebuild done: 1 rewritten, 2 unchanged, 0 errors", lines)
+            self.assertFalse(os.path.exists(rebuild_state_path()))
+
+        def test_resumes_where_the_last_run_stopped(self):
+            from unittest.mock import patch
+
+            for info in self.infos.values():
+                generate_nfo(info)
+            admitted = iter([True, True, False])
+            with patch("harbor_recording.RecorderGate.admit", lambda gate: next(admitted, True)), \
+                    patch("harbor_recording.RecorderGate.write_ms", lambda gate: 500.0):
+                lines = self.rebuild()
+            self.assertEqual(lines[-1], "rebuild done: 0 rewritten, 2 unchanged, 0 errors, 1 deferred")
+            with open(rebuild_state_path()) as f:
+                self.assertEqual(json.load(f)["cursor"], ["2025-04-01", str(self.infos["mid"])])
+
+            lines = self.rebuild()
+            self.assertIn("rebuilding 1 NFOs newest first, at most 0 files/s and 0 MB/s, resuming after 1 earlier runs",
+                          lines)
+            self.assertEqual(lines[-1], "rebuild pass complete after 2 runs: 0 rewritten, 3 unchanged, 0 errors")
+            self.assertFalse(os.path.exists(rebuild_state_path()))
+
+        def test_order_falls_back_to_info_json_date(self):
+            table = RecordingTable()
+            undated = self.dir / "twitch" / "streamer" / "vod" / "x-info.json"
+            undated.parent.mkdir()
+            undated.write_text('{"created_at": "2025-06-01T20:00:00Z"}')
+            for info in [undated, *self.infos.values()]:
+                table.add(info, status="done")
+            table.add(self.dir / "pending-info.json")
+            keys = [key for key, _ in rebuild_order(table)]
+            self.assertEqual([k[0] for k in keys], ["2025-06-01", "2025-05-01", "2025-04-01", "2025-03-01"])
+            self.assertEqual([k[0] for k, _ in rebuild_order(table, keys[1])], ["2025-04-01", "2025-03-01"])
+
+        def test_throttle_caps_files_and_bytes(self):
+            clock = [0.0]
+            slept = []
+
+            def sleep(seconds):
+                slept.append(round(seconds, 6))
+                clock[0] += seconds
+
+            throttle = Throttle(2, 1000, clock=lambda: clock[0], sleep=sleep)
+            throttle.pace(100)
+            throttle.pace(100)
+            self.assertEqual(slept, [])
+            throttle.pace(3000)
+            throttle.pace(100)
+            self.assertEqual(slept, [3.0, 0.5])
+            clock[0] += 10
+            throttle.pace(100)
+            throttle.pace(100)
+            self.assertEqual(slept, [3.0, 0.5])
+            self.assertEqual(throttle.waited, 3.5)
+
+    class TestStartup(unittest.TestCase):
+        # the hourly run with nothing new: no XML, HTTP or profiler modules,
+        # and an import budget of about 3x what it costs today
+        IMPORT_BUDGET_MS = 150 * harbor_profile.STARTUP_BUDGET_SCALE
+
+        def test_nothing_new_stays_within_budget(self):
+            with tempfile.TemporaryDirectory() as tmp:
+                (Path(tmp) / "abc-info.json").write_text("{}")
+                (Path(tmp) / "abc-video.nfo").write_text("existing")
+                report = harbor_profile.measure_startup([os.path.abspath(__file__)],
+                                                        {"TWITCH_DIR": tmp, "LOKI_URL": ""}, runs=1)
+                self.assertEqual((Path(tmp) / "abc-video.nfo").read_text(), "existing")
+
+            self.assertEqual(report.exit_code, 0)
+            self.assertEqual(report.loaded("xml", "http", "urllib.request", "ssl", "gzip", "cProfile", "tracemalloc"), [])
+            self.assertLess(report.import_ms, self.IMPORT_BUDGET_MS)
 
     loader = unittest.TestLoader()
     suite = unittest.TestSuite()
     for tc in [
         TestNfoPath, TestExtractDate, TestExtractDuration, TestFindThumbnail,
         TestFormatChapters, TestUniqueGames, TestBuildNfoXml, TestGenerateNfo,
-        TestFindInfoFiles,
+        TestRecordingTable, TestAudit, TestYieldToRecorder, TestRebuild, TestStartup,
     ]:
         suite.addTests(loader.loadTestsFromTestCase(tc))
     runner = unittest.TextTestRunner(verbosity=2)
@@ -409,12 +1257,37 @@ def main():
 
     parser = argparse.ArgumentParser(description="Twitch NFO generator for Plex/tinyMediaManager")
     parser.add_argument("--test", action="store_true", help="run unit tests")
+    parser.add_argument("--audit", action="store_true", help="check every existing NFO and regenerate broken ones")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="rewrite existing NFOs in the current format, newest first, resuming an unfinished pass")
+    parser.add_argument("--bench", choices=["memory", "audit"],
+                        help="memory: recording table vs a dict of Paths at 10k/100k/1M entries; "
+                             "audit: --audit throughput on a synthetic library")
+    harbor_profile.add_arguments(parser)
     args = parser.parse_args()
 
     if args.test:
         run_tests()
         return
+    harbor_profile.setup("twitch-nfo-generator", args, log)
+    if args.bench == "memory":
+        bench_memory()
+        return
+    if args.bench == "audit":
+        bench_audit()
+        return
 
+    try:
+        LOG.shipper = harbor_log.start_shipper()
+    except ValueError as e:
+        log(f"invalid LOKI_LABELS {harbor_log.LOKI_LABELS!r}: {e}")
+        sys.exit(1)
+    if args.audit:
+        audit()
+        return
+    if args.rebuild:
+        rebuild()
+        return
     run()
 
 